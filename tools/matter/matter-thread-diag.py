@@ -1,49 +1,73 @@
+import argparse
 import asyncio
 import websockets
 import json
 import networkx as nx
 import matplotlib.pyplot as plt
 import base64
+import hashlib
+import os
+import threading
+import time
+import uuid
 from dataclasses import dataclass
 import tkinter as tk
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from functools import partial
+from functools import partial, lru_cache
 
-@dataclass
+@dataclass(slots=True)
 class DeviceStruct:
     id: int = 0
     ext_addr: str = ""
     rloc16: str = ""
     best_lqi: int = 0
     best_rssi: int = 0
-    available: bool = True
+    available: bool = False
     is_child: bool = False
     product_name: str = ""
 
-static_devices_info  = [
+static_devices_info: dict[str, DeviceStruct] = {dev.ext_addr: dev for dev in [
     DeviceStruct(id=0, ext_addr="12:08:14:BC:94:5E:82:A3", product_name="Open Thread Border Router"),
     DeviceStruct(id=1, ext_addr="AE:1C:B7:01:D3:7F:5E:1F", product_name="Onvis S4"),
     DeviceStruct(id=15, ext_addr="8E:B1:BF:2C:82:DD:C9:F5", product_name="Arduino Matter Device LED"),
-]
+]}
 
 devices: list[DeviceStruct] = [] 
+devices_by_ext: dict[str, DeviceStruct] = {}
+
+# Network requests run on a background event loop to keep the Tk main thread responsive
+loop = asyncio.new_event_loop()
+loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+websocket = None
+refresh_future = None
+refresh_min_interval = 2.0 # seconds
+last_refresh_time = 0.0
+nodes_json_digest = None
+
+prev_pos: dict = {}
+prev_graph_signature: tuple = ()
+prev_artists: tuple = ()
+save_png = False
 
 ## Funtions related to device struct
 
+@lru_cache(maxsize=1024)
 def bas64_to_eui64(b64str):
     try:
         raw = base64.b64decode(b64str)
-        return ":".join(f"{b:02X}" for b in raw)
+        return raw.hex(":").upper()
     except Exception:
         return b64str
 
+@lru_cache(maxsize=1024)
 def int_to_eui64(val):
     try:
         intval = int(val)
-        return ":".join(f"{(intval >> (8 * i)) & 0xFF:02X}" for i in reversed(range(8)))
+        return intval.to_bytes(8, "big").hex(":").upper()
     except Exception:
         return str(val)
 
+@lru_cache(maxsize=1024)
 def int_to_rolc16(val):
     try:
         intval = int(val)
@@ -52,6 +76,12 @@ def int_to_rolc16(val):
         return str(val)
 
 def init_devices_from_neighbors_table(nodes):
+    # Local aliases for the neighbor loop
+    to_eui64 = int_to_eui64
+    to_rloc16 = int_to_rolc16
+    known = devices_by_ext
+    append = devices.append
+
     for node in nodes:
         attrs = node.get("attributes", {})
 
@@ -72,13 +102,12 @@ def init_devices_from_neighbors_table(nodes):
         # "13": IsChild (boolean)
         neighbors = attrs.get("0/53/7", [])
         for neighbor in neighbors:
-            ext_addr_raw = neighbor.get("0")
-            rloc16_raw = neighbor.get("2")
-            ext_addr = int_to_eui64(ext_addr_raw)
-            is_child = neighbor.get("13", False)
-            if not any(dev.ext_addr == ext_addr for dev in devices):
-                dev = DeviceStruct(ext_addr=ext_addr, rloc16=int_to_rolc16(rloc16_raw), is_child=is_child)
-                devices.append(dev)
+            neighbor_get = neighbor.get
+            ext_addr = to_eui64(neighbor_get("0"))
+            if ext_addr not in known:
+                dev = DeviceStruct(ext_addr=ext_addr, rloc16=to_rloc16(neighbor_get("2")), is_child=neighbor_get("13", False))
+                known[ext_addr] = dev
+                append(dev)
     
     print(f"1/ Thread devices found (number: {len(devices)}):")
     for dev in devices:
@@ -114,23 +143,21 @@ def fill_node_id(nodes):
             if type == 4:
                 hw_addr_raw = interface.get("4")
                 hw_addr = bas64_to_eui64(hw_addr_raw)
-                for dev in devices:
-                    if dev.ext_addr == hw_addr:
-                        found = True
-                        dev.id = node_id
-                        dev.product_name = attrs.get("0/40/3", "")
-                        break
+                dev = devices_by_ext.get(hw_addr)
+                if dev:
+                    found = True
+                    dev.id = node_id
+                    dev.product_name = attrs.get("0/40/3", "")
         if found:
             continue
         
     # 3. For imcomplete devices, use static device info
     for dev in devices:
         if dev.id == 0:
-            for static_dev in static_devices_info:
-                if dev.ext_addr == static_dev.ext_addr:
-                    dev.id = static_dev.id
-                    dev.product_name = static_dev.product_name
-                    break
+            static_dev = static_devices_info.get(dev.ext_addr)
+            if static_dev:
+                dev.id = static_dev.id
+                dev.product_name = static_dev.product_name
 
     # Reorder devices by id
     devices.sort(key=lambda dev: dev.id)
@@ -140,24 +167,18 @@ def fill_node_id(nodes):
         print(f"  id={dev.id:02}, ext_addr={dev.ext_addr}, rloc16={dev.rloc16}, product_name=\"{dev.product_name}\"")
 
 def fill_info(nodes):
+    devices_by_id = {dev.id: dev for dev in devices}
+    get_device = devices_by_id.get
     for node in nodes:
-        node_id = node.get("node_id")
-        available = node.get("available", False)
-        attrs = node.get("attributes", {})
-        for dev in devices:
-            if dev.id == node_id:
-                dev.available = available
-                neighbors = attrs.get("0/53/7", [])
-                for neighbor in neighbors:
-                    lqi = neighbor.get("5", 0)
-                    rssi = neighbor.get("7", 0)
-                    if lqi > dev.best_lqi:
-                        dev.best_lqi = lqi
-                        dev.best_rssi = rssi
-                    elif lqi == dev.best_lqi and rssi > dev.best_rssi:
-                        dev.best_rssi = rssi
-
-                break
+        dev = get_device(node.get("node_id"))
+        if dev:
+            dev.available = node.get("available", False)
+            neighbors = node.get("attributes", {}).get("0/53/7", [])
+            # Best link: highest LQI, then highest RSSI
+            best = max(neighbors, key=lambda n: (n.get("5", 0), n.get("7", -128)), default=None)
+            if best is not None:
+                dev.best_lqi = best.get("5", 0)
+                dev.best_rssi = best.get("7", 0)
     
     print(f"3/ Completed with all info (number: {len(devices)}):")
     for dev in devices:
@@ -165,16 +186,12 @@ def fill_info(nodes):
 
 ## Funtions related to graphic plot
 
+# Indexed by LQI ([0,3]), any other value uses index 0
+lqi_colors = ("skyblue", "red", "orange", "green")
+lqi_widths = (1, 1, 3, 5)
+
 def color_from_lqi(lqi):
-    match lqi:
-        case 1:
-            return "red"
-        case 2:
-            return "orange"
-        case 3:
-            return "green"
-        case _:
-            return "skyblue"
+    return lqi_colors[lqi] if 0 <= lqi <= 3 else lqi_colors[0]
 
 def color_from_rssi(rssi):
     if rssi >= -60:
@@ -187,18 +204,16 @@ def color_from_rssi(rssi):
         return "purple"
 
 def width_from_lqi(lqi):
-    match lqi:
-        case 1:
-            return 1
-        case 2:
-            return 3
-        case 3:
-            return 5
-        case _:
-            return 1
+    return lqi_widths[lqi] if 0 <= lqi <= 3 else lqi_widths[0]
 
 def plot_thread_topology(nodes, fig, canvas):
+    global prev_pos, prev_graph_signature, prev_artists
     G = nx.Graph()
+    devices_by_id = {dev.id: dev for dev in devices}
+
+    # Local aliases for the neighbor loop
+    to_eui64 = int_to_eui64
+    add_edge = G.add_edge
 
     for dev in devices:
         if not dev.available:
@@ -212,13 +227,8 @@ def plot_thread_topology(nodes, fig, canvas):
     
     for node in nodes:
         node_id = node.get("node_id")
-
-        for dev in devices:
-            if dev.id == node_id:
-                device = dev
-                break
-
-        if not device:
+        device = devices_by_id.get(node_id)
+        if device is None:
             print(f"Node {node_id} not found in devices list, skipping...")
             continue
 
@@ -228,73 +238,163 @@ def plot_thread_topology(nodes, fig, canvas):
         attrs = node.get("attributes", {})
         neighbors = attrs.get("0/53/7", [])
 
+        device_ext_addr = device.ext_addr
         for n in neighbors:
-            neighbor_ext_addr_raw = n.get("0")
-            neighbor_ext_addr = int_to_eui64(neighbor_ext_addr_raw)
-            rssi = n.get("7", -100)
-            lqi = n.get("5", 0)
-            G.add_edge(device.ext_addr, neighbor_ext_addr, color=color_from_rssi(rssi), width=width_from_lqi(lqi))
+            n_get = n.get
+            neighbor_ext_addr = to_eui64(n_get("0"))
+            add_edge(device_ext_addr, neighbor_ext_addr, color=color_from_rssi(n_get("7", -100)), width=width_from_lqi(n_get("5", 0)))
 
     # Plot
-    fig.clear()
-    ax = fig.add_subplot(111)
-
-    plt.figure(figsize=(10, 6))
-    pos = nx.spring_layout(G, k=1.1, seed=4)
-    node_labels = {n: G.nodes[n]['label'] for n in G.nodes}
-    node_colors = [G.nodes[n]['color'] for n in G.nodes]
-    edge_colors = [G.edges[n]['color'] for n in G.edges]
-    edge_width = [G.edges[n]['width'] for n in G.edges]
-    
-    nx.draw(G, pos, with_labels=True, edge_color=edge_colors, width=edge_width, node_color=node_colors, labels=node_labels, node_size=3000, font_size=10)
-    nx.draw(G, pos, with_labels=True, edge_color=edge_colors, width=edge_width, node_color=node_colors, labels=node_labels, node_size=3000, font_size=10, ax=ax)
+    signature = (frozenset(G.nodes), frozenset(frozenset(e) for e in G.edges))
+    if signature == prev_graph_signature and prev_artists:
+        # Same topology: only update colors, widths and labels of the existing drawing
+        node_list, edge_list, node_collection, edge_collection, label_texts = prev_artists
+        node_collection.set_facecolor([G.nodes[n]['color'] for n in node_list])
+        if edge_list:
+            edge_collection.set_color([G.edges[e]['color'] for e in edge_list])
+            edge_collection.set_linewidth([G.edges[e]['width'] for e in edge_list])
+        for n, text in label_texts.items():
+            text.set_text(G.nodes[n]['label'])
+    else:
+        # Topology changed: warm-start the layout from the previous positions
+        warm_pos = {n: p for n, p in prev_pos.items() if n in G}
+        if warm_pos:
+            pos = nx.spring_layout(G, k=1.1, seed=4, pos=warm_pos, iterations=20)
+        else:
+            pos = nx.spring_layout(G, k=1.1, seed=4)
+
+        node_list = list(G.nodes)
+        edge_list = list(G.edges)
+        node_labels = {n: G.nodes[n]['label'] for n in node_list}
+        node_colors = [G.nodes[n]['color'] for n in node_list]
+        edge_colors = [G.edges[e]['color'] for e in edge_list]
+        edge_width = [G.edges[e]['width'] for e in edge_list]
+
+        fig.clear()
+        ax = fig.add_subplot(111)
+        node_collection = nx.draw_networkx_nodes(G, pos, ax=ax, nodelist=node_list, node_color=node_colors, node_size=3000)
+        edge_collection = nx.draw_networkx_edges(G, pos, ax=ax, edgelist=edge_list, edge_color=edge_colors, width=edge_width, node_size=3000)
+        label_texts = nx.draw_networkx_labels(G, pos, ax=ax, labels=node_labels, font_size=10)
+        ax.set_axis_off()
+        ax.set_title("Thread Topology")
+        fig.tight_layout()
+
+        prev_pos, prev_graph_signature = pos, signature
+        prev_artists = (node_list, edge_list, node_collection, edge_collection, label_texts)
 
     # Save image
-    plt.title("Thread Topology")
-    plt.tight_layout()
-    plt.savefig("thread_topology.png")
+    if save_png:
+        fig.savefig("thread_topology.png")
 
     # Screen plot
-    fig.tight_layout()
     canvas.draw()
 
-def on_refresh(fig, canvas):
+def on_refresh(root, fig, canvas):
+    global refresh_future
+    if refresh_future is not None and not refresh_future.done():
+        print("Refresh already in progress...")
+        return
+    if time.monotonic() - last_refresh_time < refresh_min_interval:
+        print(f"Graph refreshed less than {refresh_min_interval}s ago, skipping...")
+        return
     print("Refreshing graph...")
-    nodes = update_devices_info()
+    refresh_future = asyncio.run_coroutine_threadsafe(get_nodes(), loop)
+    refresh_future.add_done_callback(partial(schedule_nodes_received, root, fig, canvas))
+
+def schedule_nodes_received(root, fig, canvas, future):
+    # Called on the event loop thread, hand the result over to the Tk main thread
+    try:
+        root.after(0, on_nodes_received, future, fig, canvas)
+    except (RuntimeError, tk.TclError):
+        # The window has been closed in the meantime
+        pass
+
+def on_nodes_received(future, fig, canvas):
+    try:
+        nodes = future.result()
+    except asyncio.CancelledError:
+        return
+    except Exception as e:
+        print("Failed to get nodes:", e)
+        return
+    update_devices_info(nodes)
     plot_thread_topology(nodes, fig, canvas)
 
 ## Funtions related to get data from server
 
+def save_nodes(nodes):
+    global nodes_json_digest
+    payload = json.dumps(nodes, indent=2).encode()
+    digest = hashlib.blake2b(payload).digest()
+    if digest == nodes_json_digest:
+        return
+    # Write to a temporary file first so nodes.json is never left half written
+    with open("nodes.json.tmp", "wb") as f:
+        f.write(payload)
+    os.replace("nodes.json.tmp", "nodes.json")
+    nodes_json_digest = digest
+
 async def get_nodes():
+    global websocket
     uri = "ws://192.168.1.2:5580/ws"
-    message_id = "1"
-    async with websockets.connect(uri) as websocket:
-        await websocket.send(json.dumps({"message_id": message_id, "command": "get_nodes"}))
-        while True:
-            response = await websocket.recv()
-            try:
-                data = json.loads(response)
-                #print("JSON message received :", data)
-                if data.get("message_id") == message_id and "result" in data:
-                    nodes = data.get("result")
-                    if isinstance(nodes, list):
-                        with open("nodes.json", "w") as f:
-                            json.dump(nodes, f, indent=2)
-                        return nodes
-            except json.JSONDecodeError:
-                print("Not JSON message:", response)
-
-def update_devices_info():
-    nodes = asyncio.run(get_nodes())
+    message_id = uuid.uuid4().hex
+    message_id_bytes = message_id.encode()
+    for attempt in range(2):
+        if websocket is None:
+            websocket = await websockets.connect(uri, compression=None)
+        try:
+            await websocket.send(json.dumps({"message_id": message_id, "command": "get_nodes"}))
+            while True:
+                response = await websocket.recv()
+                # Skip unrelated frames (events, server info) without decoding them
+                if (message_id if isinstance(response, str) else message_id_bytes) not in response:
+                    continue
+                try:
+                    data = json.loads(response)
+                    #print("JSON message received :", data)
+                    if data.get("message_id") == message_id and "result" in data:
+                        nodes = data.get("result")
+                        if isinstance(nodes, list):
+                            save_nodes(nodes)
+                            return nodes
+                except json.JSONDecodeError:
+                    print("Not JSON message:", response)
+        except websockets.ConnectionClosed:
+            websocket = None
+            if attempt:
+                raise
+            print("Connection closed, reconnecting...")
+
+async def close_connection():
+    # Cancel a pending get_nodes first, otherwise it would see the close as a server drop and reconnect
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if websocket is not None:
+        await websocket.close()
+
+def update_devices_info(nodes):
+    global last_refresh_time
+    last_refresh_time = time.monotonic()
+    # Rebuild the devices list from scratch on each refresh
+    devices.clear()
+    devices_by_ext.clear()
     init_devices_from_neighbors_table(nodes)
     fill_node_id(nodes)
     fill_info(nodes)
-    return nodes
 
 ## Main
 
 if __name__ == "__main__":
-    nodes = update_devices_info()
+    parser = argparse.ArgumentParser(description="Plot the Thread network topology from a Matter server")
+    parser.add_argument("--save-png", action="store_true", help="save the plot to thread_topology.png on each refresh")
+    args = parser.parse_args()
+    save_png = args.save_png
+
+    loop_thread.start()
+    nodes = asyncio.run_coroutine_threadsafe(get_nodes(), loop).result()
+    update_devices_info(nodes)
 
     root = tk.Tk()
     root.title("Network Graph")
@@ -303,8 +403,13 @@ if __name__ == "__main__":
     canvas = FigureCanvasTkAgg(fig, master=root)
     canvas.get_tk_widget().pack()
 
-    button = tk.Button(root, text="Refresh", command=partial(on_refresh, fig, canvas))
+    button = tk.Button(root, text="Refresh", command=partial(on_refresh, root, fig, canvas))
     button.pack()
 
     plot_thread_topology(nodes, fig, canvas)
     root.mainloop()
+
+    asyncio.run_coroutine_threadsafe(close_connection(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    loop.close()